@@ -11,27 +11,30 @@ Notes:
 """
 
 import logging
+import math
 import os
 import pickle
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from scipy.stats import (
-    truncnorm,  # we need to sample from truncated normal distributions
-)
+from numba import njit, prange
+from numba.extending import register_jitable
+from scipy.special import ndtr, ndtri
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # Simulation Constants
 
 # Spherical calculations - tumours assumed to be spherical per Winer-Muram et al 2002.
 # URL: https://pubs.rsna.org/doi/10.1148/radiol.2233011026?url_ver=Z39.88-2003&rfr_id=ori%3Arid%3Acrossref.org&rfr_dat=cr_pub%3Dpubmed
+# Plain arithmetic so they work on scalars and arrays, and inline into the jitted kernels
+@register_jitable
 def calc_volume(diameter):
-    return 4.0 / 3.0 * np.pi * (diameter / 2.0) ** 3.0
+    return 4.0 / 3.0 * math.pi * (diameter / 2.0) ** 3.0
 
 
+@register_jitable
 def calc_diameter(volume):
-    return ((volume / (4.0 / 3.0 * np.pi)) ** (1.0 / 3.0)) * 2.0
+    return ((volume / (4.0 / 3.0 * math.pi)) ** (1.0 / 3.0)) * 2.0
 
 
 # Tumour constants per
@@ -65,7 +68,24 @@ cancer_stage_observations = {
 # Simulation Functions
 
 
-def get_confounding_params(num_patients, chemo_coeff, radio_coeff):
+def _truncnorm_rvs(a, b, rng, size=None):
+    """
+    Sample a standard normal truncated to [a, b] by inverse-CDF sampling.
+    Same distribution as scipy.stats.truncnorm.rvs(a, b, size=size), minus the scipy overhead.
+    :param a: lower bound(s) in standard normal units
+    :param b: upper bound(s) in standard normal units
+    :param rng: numpy Generator to draw from
+    :param size: output shape, defaults to the broadcast shape of a and b
+    :return: samples
+    """
+    if size is None:
+        size = np.broadcast(a, b).shape
+    cdf_a = ndtr(a)
+    cdf_b = ndtr(b)
+    return ndtri(cdf_a + rng.random(size) * (cdf_b - cdf_a))
+
+
+def get_confounding_params(num_patients, chemo_coeff, radio_coeff, rng=None):
     """
 
     Get original simulation parameters, and add extra ones to control confounding
@@ -74,47 +94,43 @@ def get_confounding_params(num_patients, chemo_coeff, radio_coeff):
     :param num_patients:
     :param chemo_coeff: Bias on action policy for chemotherapy assignments
     :param radio_activation_group: Bias on action policy for chemotherapy assignments
+    :param rng: numpy Generator, a freshly seeded one is used if None
     :return:
     """
 
-    basic_params = get_standard_params(num_patients)
+    basic_params = get_standard_params(num_patients, rng=rng)
     patient_types = basic_params["patient_types"]
     tumour_stage_centres = [s for s in cancer_stage_observations if "IIIA" not in s]
     # 相当于除去了IIIA型，为什么要把这个型扔掉呢
     tumour_stage_centres.sort()
 
     d_max = calc_diameter(tumour_death_threshold)  # 其实就是13
-    basic_params["chemo_sigmoid_intercepts"] = np.array(
-        [d_max / 2.0 for i in patient_types],
-    )
-    basic_params["radio_sigmoid_intercepts"] = np.array(
-        [d_max / 2.0 for i in patient_types],
-    )
+    basic_params["chemo_sigmoid_intercepts"] = np.full(num_patients, d_max / 2.0)
+    basic_params["radio_sigmoid_intercepts"] = np.full(num_patients, d_max / 2.0)
 
-    basic_params["chemo_sigmoid_betas"] = np.array(
-        [chemo_coeff / d_max for i in patient_types],
-    )
-    basic_params["radio_sigmoid_betas"] = np.array(
-        [radio_coeff / d_max for i in patient_types],
-    )
+    basic_params["chemo_sigmoid_betas"] = np.full(num_patients, chemo_coeff / d_max)
+    basic_params["radio_sigmoid_betas"] = np.full(num_patients, radio_coeff / d_max)
 
     return basic_params
 
 
-def get_standard_params(num_patients):  # additional params
+def get_standard_params(num_patients, rng=None):  # additional params
     """
     Simulation parameters from the Nature article + adjustments for static variables
     考虑了tumor growth model里面最基本的参数，以及考虑了不同人群的treatment response
     :param num_patients:
+    :param rng: numpy Generator, a freshly seeded one is used if None
     :return: simulation_parameters
     """
+    if rng is None:
+        rng = np.random.default_rng()
 
     # Adjustments for static variables
     # 产生三组不同的treatment response
     possible_patient_types = [1, 2, 3]
-    patient_types = np.random.choice(possible_patient_types, num_patients)
-    chemo_mean_adjustments = np.array([0.0 if i < 3 else 0.1 for i in patient_types])
-    radio_mean_adjustments = np.array([0.0 if i > 1 else 0.1 for i in patient_types])
+    patient_types = rng.choice(possible_patient_types, num_patients)
+    chemo_mean_adjustments = np.where(patient_types >= 3, 0.1, 0.0)
+    radio_mean_adjustments = np.where(patient_types <= 1, 0.1, 0.0)
 
     total = 0
     for k in cancer_stage_observations:
@@ -128,44 +144,52 @@ def get_standard_params(num_patients):  # additional params
     possible_stages = list(tumour_size_distributions.keys())
     possible_stages.sort()
 
-    initial_stages = np.random.choice(
-        possible_stages,
+    stage_idx = rng.choice(
+        len(possible_stages),
         num_patients,
         p=[cancer_stage_proportions[k] for k in possible_stages],
     )
+    initial_stages = np.array(possible_stages)[stage_idx]
     # 相当于产生长度10000的list，list的内容是肿瘤的型，代表每个病人最开始的肿瘤类型
     # 分配的概率是根据上面实际观测的比例，使得最后每个类型的病人人数比例和真实情况尽可能相符合
 
     # Get info on patient stages and initial volumes
     # 得到每个病人最开始的肿瘤类型，并根据肿瘤类型得到这个类型的体积大小分布，并得到最开始的体积大小
-    output_initial_diam = []
-    patient_sim_stages = []
-    for stg in possible_stages:
-        count = np.sum((initial_stages == stg) * 1)
+    mus, sigmas, lower_bounds, upper_bounds = np.array(
+        [tumour_size_distributions[stg] for stg in possible_stages],
+    ).T
 
-        mu, sigma, lower_bound, upper_bound = tumour_size_distributions[stg]
-
-        # Convert lognorm bounds in to standard normal bounds
-        lower_bound = (np.log(lower_bound) - mu) / sigma
-        upper_bound = (np.log(upper_bound) - mu) / sigma
+    # Convert lognorm bounds in to standard normal bounds
+    lower_bounds = (np.log(lower_bounds) - mus) / sigmas
+    upper_bounds = (np.log(upper_bounds) - mus) / sigmas
 
+    stage_counts = np.bincount(stage_idx, minlength=len(possible_stages))
+    for k, stg in enumerate(possible_stages):
         logging.info(
             (
-                "Simulating initial volumes for stage {} "
+                "Simulating initial volumes for {} patients at stage {} "
                 + " with norm params: mu={}, sigma={}, lb={}, ub={}"
-            ).format(stg, mu, sigma, lower_bound, upper_bound),
+            ).format(
+                stage_counts[k],
+                stg,
+                mus[k],
+                sigmas[k],
+                lower_bounds[k],
+                upper_bounds[k],
+            ),
         )
 
-        norm_rvs = truncnorm.rvs(
-            lower_bound,
-            upper_bound,
-            size=count,
-        )  # truncated normal for realistic clinical outcome
-        # 这里就是生成lower bound 到 upper bound，均值=0方差=1的这么多个数据点
+    # Per-patient distribution parameters, so all stages are sampled in one pass
+    mus = mus[stage_idx]
+    sigmas = sigmas[stage_idx]
+    norm_rvs = _truncnorm_rvs(
+        lower_bounds[stage_idx],
+        upper_bounds[stage_idx],
+        rng,
+    )  # truncated normal for realistic clinical outcome
+    # 这里就是生成lower bound 到 upper bound，均值=0方差=1的这么多个数据点
 
-        initial_volume_by_stage = np.exp((norm_rvs * sigma) + mu)  # 得到最开始的肿瘤体积大小
-        output_initial_diam += list(initial_volume_by_stage)
-        patient_sim_stages += [stg for i in range(count)]
+    output_initial_diam = np.exp((norm_rvs * sigmas) + mus)  # 得到最开始的肿瘤体积大小
 
     # Fixed params
     K = calc_volume(30)  # carrying capacity given in cm, so convert to volume
@@ -191,35 +215,29 @@ def get_standard_params(num_patients):  # additional params
 
     alpha_rho_mean = np.array([alpha_params[0], rho_params[0]])
 
-    simulated_params = []
+    simulated_params = np.empty((0, 2))
 
     while (
-        len(simulated_params) < num_patients
+        simulated_params.shape[0] < num_patients
     ):  # Keep on simulating till we get the right number of params
 
-        param_holder = np.random.multivariate_normal(
+        param_holder = rng.multivariate_normal(
             alpha_rho_mean,
             alpha_rho_cov,
             size=num_patients,
+            method="cholesky",
         )
         # 10000 * 2的size，根据alpha和rho的covariances来生成，相当于每个病人都有alpha和rho的值了
 
-        for i in range(param_holder.shape[0]):
-
-            # Ensure that all params fulfill conditions
-            if (
-                param_holder[i, 0] > parameter_lower_bound
-                and param_holder[i, 1] > parameter_lower_bound
-            ):
-                simulated_params.append(param_holder[i, :])
+        # Ensure that all params fulfill conditions
+        valid = np.all(param_holder > parameter_lower_bound, axis=1)
+        simulated_params = np.concatenate([simulated_params, param_holder[valid]])
 
         logging.info(
-            "Got correlated params for {} patients".format(len(simulated_params)),
+            "Got correlated params for {} patients".format(simulated_params.shape[0]),
         )
 
-    simulated_params = np.array(simulated_params)[
-        :num_patients, :
-    ]  # shorten this back to normal
+    simulated_params = simulated_params[:num_patients, :]  # shorten this back to normal
     alpha_adjustments = alpha_params[0] * radio_mean_adjustments
     alpha = simulated_params[:, 0] + alpha_adjustments
     # 这里就是产生three group of patients，把group 1的alpha r乘以1.1
@@ -232,9 +250,10 @@ def get_standard_params(num_patients):  # additional params
     beta_c = (
         beta_c_params[0]
         + beta_c_params[1]
-        * truncnorm.rvs(
+        * _truncnorm_rvs(
             (parameter_lower_bound - beta_c_params[0]) / beta_c_params[1],
             (parameter_upper_bound - beta_c_params[0]) / beta_c_params[1],
+            rng,
             size=num_patients,
         )
         + beta_c_adjustments
@@ -244,23 +263,22 @@ def get_standard_params(num_patients):  # additional params
 
     output_holder = {
         "patient_types": patient_types,
-        "initial_stages": np.array(patient_sim_stages),
+        "initial_stages": initial_stages,
         "initial_volumes": calc_volume(
-            np.array(output_initial_diam),
+            output_initial_diam,
         ),  # assumed spherical with diam
         "alpha": alpha,
         "rho": rho,
         "beta": beta,
         "beta_c": beta_c,
-        "K": np.array([K for i in range(num_patients)]),
+        "K": np.full(num_patients, K),
     }
     # np.random.exponential(expected_treatment_delay, num_patients),
 
     # Randomise output params
     # 按照病人的维度打乱
     logging.info("Randomising outputs")
-    idx = [i for i in range(num_patients)]
-    np.random.shuffle(idx)
+    idx = rng.permutation(num_patients)
 
     output_params = {}
     for k in output_holder:
@@ -269,206 +287,193 @@ def get_standard_params(num_patients):  # additional params
     return output_params
 
 
-def simulate(simulation_params, num_time_steps, assigned_actions=None):
+@register_jitable
+def _decay_chemo(previous_dose, new_dose, decay):
     """
-    Core routine to generate simulation paths
-
-    :param simulation_params:
-    :param num_time_steps:
-    :param assigned_actions:
-    :return:
+    Chemo concentration after one day of decay plus any newly applied dose.
     """
+    return previous_dose * decay + new_dose
+
+
+@register_jitable
+def _growth_step(
+    volume,
+    rho,
+    log_K,
+    beta_c,
+    chemo_dose,
+    alpha,
+    beta,
+    radio_dose,
+    noise,
+    log_offset=0.0,
+):
+    """
+    Tumour volume after one day of growth under the given chemo and radio doses.
+    Shared by every simulator so the factual and counterfactual dynamics cannot drift apart.
+    The sequence projections are not clipped and pass a small log_offset, as their
+    volume can reach zero.
+    """
+    return volume * (
+        1.0
+        + rho * (log_K - np.log(volume + log_offset))
+        - beta_c * chemo_dose
+        - alpha * radio_dose
+        - beta * radio_dose * radio_dose
+        + noise
+    )
 
-    total_num_radio_treatments = 1
-    total_num_chemo_treatments = 1
-
-    radio_amt = np.array([2.0 for i in range(total_num_radio_treatments)])  # Gy
-    radio_days = np.array([i + 1 for i in range(total_num_radio_treatments)])
-    chemo_amt = [5.0 for i in range(total_num_chemo_treatments)]
-    chemo_days = [(i + 1) * 7 for i in range(total_num_chemo_treatments)]
-
-    # sort this
-    chemo_idx = np.argsort(chemo_days)
-    chemo_amt = np.array(chemo_amt)[chemo_idx]
-    chemo_days = np.array(chemo_days)[chemo_idx]
-
-    drug_half_life = 1  # one day half life for drugs
-
-    # Unpack simulation parameters
-    initial_stages = simulation_params["initial_stages"]
-    initial_volumes = simulation_params["initial_volumes"]
-    alphas = simulation_params["alpha"]
-    rhos = simulation_params["rho"]
-    betas = simulation_params["beta"]
-    beta_cs = simulation_params["beta_c"]
-    Ks = simulation_params["K"]
-    patient_types = simulation_params["patient_types"]
-    window_size = simulation_params[
-        "window_size"
-    ]  # controls the lookback of the treatment assignment policy
-
-    # Coefficients for treatment assignment probabilities
-    chemo_sigmoid_intercepts = simulation_params["chemo_sigmoid_intercepts"]
-    radio_sigmoid_intercepts = simulation_params["radio_sigmoid_intercepts"]
-    chemo_sigmoid_betas = simulation_params["chemo_sigmoid_betas"]
-    radio_sigmoid_betas = simulation_params["radio_sigmoid_betas"]
-
-    num_patients = initial_stages.shape[0]
-
-    # Commence Simulation
-    cancer_volume = np.zeros((num_patients, num_time_steps))
-    chemo_dosage = np.zeros((num_patients, num_time_steps))
-    radio_dosage = np.zeros((num_patients, num_time_steps))
-    chemo_application_point = np.zeros((num_patients, num_time_steps))
-    radio_application_point = np.zeros((num_patients, num_time_steps))
-    sequence_lengths = np.zeros(num_patients)
-    death_flags = np.zeros((num_patients, num_time_steps))
-    recovery_flags = np.zeros((num_patients, num_time_steps))
-    chemo_probabilities = np.zeros((num_patients, num_time_steps))
-    radio_probabilities = np.zeros((num_patients, num_time_steps))
 
-    noise_terms = 0.01 * np.random.randn(
-        num_patients,
-        num_time_steps,
-    )  # 5% cell variability
-    recovery_rvs = np.random.rand(num_patients, num_time_steps)
-
-    chemo_application_rvs = np.random.rand(num_patients, num_time_steps)
-    radio_application_rvs = np.random.rand(num_patients, num_time_steps)
-    # 相当于先把做chemo和radio的概率算出来，到时候在跟threshold比，比threshold大，就assign treatment
+@njit(parallel=True, fastmath=True, cache=True)
+def _simulate_kernel(
+    cancer_volume,
+    chemo_dosage,
+    radio_dosage,
+    chemo_application_point,
+    radio_application_point,
+    chemo_probabilities,
+    radio_probabilities,
+    sequence_lengths,
+    initial_volumes,
+    alphas,
+    rhos,
+    betas,
+    beta_cs,
+    Ks,
+    chemo_sigmoid_intercepts,
+    radio_sigmoid_intercepts,
+    chemo_sigmoid_betas,
+    radio_sigmoid_betas,
+    noise_terms,
+    recovery_volumes,
+    chemo_application_rvs,
+    radio_application_rvs,
+    assigned_actions,
+    window_size,
+    radio_amt,
+    chemo_amt,
+    decay,
+    death_threshold,
+):
+    """
+    Compiled inner loop of simulate - fills the output buffers in place.
+    An empty assigned_actions array means the sigmoid policy is used.
+    Patients are independent (each only touches row i), so they run in parallel.
+    """
+    num_patients, num_time_steps = cancer_volume.shape
+    use_assigned_actions = assigned_actions.shape[0] > 0
 
-    # Run actual simulation
-    for i in range(num_patients):
-        if i % 200 == 0:
-            logging.info("Simulating patient {} of {}".format(i, num_patients))
+    for i in prange(num_patients):
         noise = noise_terms[i]
 
-        # initial values
-        cancer_volume[i, 0] = initial_volumes[i]
+        # initial values, the state is carried in float64 and only stored in the buffers
+        volume = initial_volumes[i]
+        chemo_dose = 0.0
+        cancer_volume[i, 0] = volume
         alpha = alphas[i]
         beta = betas[i]
         beta_c = beta_cs[i]
         rho = rhos[i]
-        K = Ks[i]
-
-        # Setup cell volume
-        b_death = False
-        b_recover = False
+        log_K = math.log(Ks[i])  # growth only needs log(K / V)
+        chemo_sigmoid_beta = chemo_sigmoid_betas[i]
+        chemo_sigmoid_intercept = chemo_sigmoid_intercepts[i]
+        radio_sigmoid_beta = radio_sigmoid_betas[i]
+        radio_sigmoid_intercept = radio_sigmoid_intercepts[i]
+
+        sequence_length = num_time_steps - 1
+        diameter_sum = 0.0  # sliding sum of diameters over the lookback window
         for t in range(0, num_time_steps - 1):
 
-            current_chemo_dose = 0.0
-            previous_chemo_dose = 0.0 if t == 0 else chemo_dosage[i, t - 1]
+            previous_chemo_dose = chemo_dose
 
             # Action probabilities + death or recovery simulations
-            cancer_volume_used = cancer_volume[i, max(t - window_size, 0) : t + 1]
-            cancer_diameter_used = np.array(
-                [calc_diameter(vol) for vol in cancer_volume_used],
-            ).mean()  # mean diameter over 15 days
-            cancer_metric_used = cancer_diameter_used
+            # mean diameter over the lookback window
+            window_start = max(t - window_size, 0)
+            diameter_sum += calc_diameter(cancer_volume[i, t])
+            if window_start > 0:
+                diameter_sum -= calc_diameter(cancer_volume[i, window_start - 1])
+            cancer_metric_used = diameter_sum / (t + 1 - window_start)
 
             # probabilities
-            if assigned_actions is not None:
+            if use_assigned_actions:
                 chemo_prob = assigned_actions[i, t, 0]
                 radio_prob = assigned_actions[i, t, 1]
             else:
-
                 radio_prob = 1.0 / (
                     1.0
-                    + np.exp(
-                        -radio_sigmoid_betas[i]
-                        * (cancer_metric_used - radio_sigmoid_intercepts[i]),
+                    + math.exp(
+                        -radio_sigmoid_beta
+                        * (cancer_metric_used - radio_sigmoid_intercept),
                     )
-                )  # 这里其实就是treatment assignment的概率计算，选择了使用sigmoid函数激活
+                )
                 chemo_prob = 1.0 / (
                     1.0
-                    + np.exp(
-                        -chemo_sigmoid_betas[i]
-                        * (cancer_metric_used - chemo_sigmoid_intercepts[i]),
+                    + math.exp(
+                        -chemo_sigmoid_beta
+                        * (cancer_metric_used - chemo_sigmoid_intercept),
                     )
                 )
             chemo_probabilities[i, t] = chemo_prob
             radio_probabilities[i, t] = radio_prob
 
-            # Action application
-            # 如果满足条件，就施加radio或者chemo治疗
-            if radio_application_rvs[i, t] < radio_prob:
-                radio_application_point[i, t] = 1
-                radio_dosage[i, t] = radio_amt[0]
-
-            if chemo_application_rvs[i, t] < chemo_prob:
-                # Apply chemo treatment
-                chemo_application_point[i, t] = 1
-                current_chemo_dose = chemo_amt[0]
+            # Action application, as a select rather than a branch on the random draw
+            apply_radio = 1.0 if radio_application_rvs[i, t] < radio_prob else 0.0
+            apply_chemo = 1.0 if chemo_application_rvs[i, t] < chemo_prob else 0.0
+            radio_application_point[i, t] = apply_radio
+            chemo_application_point[i, t] = apply_chemo
+            radio_dose = apply_radio * radio_amt
+            radio_dosage[i, t] = radio_dose
+            current_chemo_dose = apply_chemo * chemo_amt
 
             # Update chemo dosage
-            chemo_dosage[i, t] = (
-                previous_chemo_dose * np.exp(-np.log(2) / drug_half_life)
-                + current_chemo_dose
-            )
-            # 这里就是chemo浓度本身的变化，当然可能这个时间点有新加的chemo
-
-            cancer_volume[i, t + 1] = cancer_volume[i, t] * (
-                1
-                + +rho * np.log(K / cancer_volume[i, t])
-                - beta_c * chemo_dosage[i, t]
-                - (alpha * radio_dosage[i, t] + beta * radio_dosage[i, t] ** 2)
-                + noise[t]
+            chemo_dose = _decay_chemo(previous_chemo_dose, current_chemo_dose, decay)
+            chemo_dosage[i, t] = chemo_dose
+
+            next_volume = _growth_step(
+                volume,
+                rho,
+                log_K,
+                beta_c,
+                chemo_dose,
+                alpha,
+                beta,
+                radio_dose,
+                noise[t],
             )  # add noise to fit residuals
-            # 所以每个时间点的肿瘤大小就知道了
+            cancer_volume[i, t + 1] = next_volume
+            volume = next_volume
 
-            if cancer_volume[i, t + 1] > tumour_death_threshold:
-                cancer_volume[i, t + 1] = tumour_death_threshold
+            if next_volume > death_threshold:
+                cancer_volume[i, t + 1] = death_threshold
+                sequence_length = t + 1
                 break  # patient death
 
             # recovery threshold as defined by the previous stuff
-            if recovery_rvs[i, t + 1] < np.exp(
-                -cancer_volume[i, t + 1] * tumour_cell_density,
-            ):
+            if next_volume < recovery_volumes[i, t + 1]:
                 cancer_volume[i, t + 1] = 0
+                sequence_length = t + 1
                 break
 
         # Package outputs
-        sequence_lengths[i] = int(t + 1)
-
-    outputs = {
-        "cancer_volume": cancer_volume,
-        "chemo_dosage": chemo_dosage,
-        "radio_dosage": radio_dosage,
-        "chemo_application": chemo_application_point,
-        "radio_application": radio_application_point,
-        "chemo_probabilities": chemo_probabilities,
-        "radio_probabilities": radio_probabilities,
-        "sequence_lengths": sequence_lengths,
-        "patient_types": patient_types,
-    }
-    # 这个地方的cancer volume就包括所有病人所有时间的肿瘤大小了了，当然有可能death或者康复了后面的时间就没有记录
-    # dosage应该是浓度大小，application是施加treatment与否
-
-    return outputs
+        sequence_lengths[i] = sequence_length
 
 
-def simulate_counterfactual_test_data(
-    simulation_params,
-    num_time_steps,
-    assigned_actions=None,
-):
+def simulate(simulation_params, num_time_steps, assigned_actions=None, rng=None):
     """
-    Core routine to generate simulation test paths to asses all of the counterfactuals.
-    就是对于原来的factual产生synthetic dataset的过程，迭代所有的treatment，产生对应的tumor大小
+    Core routine to generate simulation paths
+
     :param simulation_params:
     :param num_time_steps:
     :param assigned_actions:
+    :param rng: numpy Generator, a freshly seeded one is used if None
     :return:
     """
-    np.random.seed(100)
+    if rng is None:
+        rng = np.random.default_rng()
 
     total_num_radio_treatments = 1
     total_num_chemo_treatments = 1
 
-    num_treatments = (
-        4  # No treatment/Chemotherapy/Radiotherapy/Chemotherapy + Radiotherapy
-    )
-
     radio_amt = np.array([2.0 for i in range(total_num_radio_treatments)])  # Gy
     radio_days = np.array([i + 1 for i in range(total_num_radio_treatments)])
     chemo_amt = [5.0 for i in range(total_num_chemo_treatments)]
@@ -480,6 +485,7 @@ def simulate_counterfactual_test_data(
     chemo_days = np.array(chemo_days)[chemo_idx]
 
     drug_half_life = 1  # one day half life for drugs
+    decay = math.exp(-math.log(2) / drug_half_life)  # daily chemo decay factor
 
     # Unpack simulation parameters
     initial_stages = simulation_params["initial_stages"]
@@ -502,213 +508,406 @@ def simulate_counterfactual_test_data(
 
     num_patients = initial_stages.shape[0]
 
-    num_test_points = num_patients * num_time_steps * num_treatments
-
     # Commence Simulation
-    cancer_volume = np.zeros((num_test_points, num_time_steps))
-    chemo_application_point = np.zeros((num_test_points, num_time_steps))
-    radio_application_point = np.zeros((num_test_points, num_time_steps))
-    sequence_lengths = np.zeros(num_test_points)
-    patient_types_all_trajectories = np.zeros(num_test_points)
+    # Trajectories are stored in float32, the simulation itself runs in float64
+    cancer_volume = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    chemo_dosage = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    radio_dosage = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    chemo_application_point = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    radio_application_point = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    sequence_lengths = np.zeros(num_patients)
+    death_flags = np.zeros((num_patients, num_time_steps))
+    recovery_flags = np.zeros((num_patients, num_time_steps))
+    chemo_probabilities = np.zeros((num_patients, num_time_steps), dtype=np.float32)
+    radio_probabilities = np.zeros((num_patients, num_time_steps), dtype=np.float32)
 
-    test_idx = 0
+    noise_terms = 0.01 * rng.standard_normal(
+        (num_patients, num_time_steps),
+    )  # 5% cell variability
+    recovery_rvs = rng.random((num_patients, num_time_steps))
+    # Recovery when rv < exp(-V * density), i.e. once V drops below -log(rv) / density
+    recovery_volumes = -np.log(recovery_rvs) / tumour_cell_density
+
+    chemo_application_rvs = rng.random((num_patients, num_time_steps))
+    radio_application_rvs = rng.random((num_patients, num_time_steps))
+    # 相当于先把做chemo和radio的概率算出来，到时候在跟threshold比，比threshold大，就assign treatment
+
+    if assigned_actions is None:
+        assigned_actions = np.zeros((0, 0, 2))
 
     # Run actual simulation
-    for i in range(num_patients):
+    logging.info("Simulating {} patients".format(num_patients))
+    _simulate_kernel(
+        cancer_volume,
+        chemo_dosage,
+        radio_dosage,
+        chemo_application_point,
+        radio_application_point,
+        chemo_probabilities,
+        radio_probabilities,
+        sequence_lengths,
+        initial_volumes,
+        alphas,
+        rhos,
+        betas,
+        beta_cs,
+        Ks,
+        chemo_sigmoid_intercepts,
+        radio_sigmoid_intercepts,
+        chemo_sigmoid_betas,
+        radio_sigmoid_betas,
+        noise_terms,
+        recovery_volumes,
+        chemo_application_rvs,
+        radio_application_rvs,
+        np.asarray(assigned_actions, dtype=np.float64),
+        window_size,
+        radio_amt[0],
+        chemo_amt[0],
+        decay,
+        tumour_death_threshold,
+    )
 
-        if i % 200 == 0:
-            logging.info("Simulating patient {} of {}".format(i, num_patients))
+    outputs = {
+        "cancer_volume": cancer_volume,
+        "chemo_dosage": chemo_dosage,
+        "radio_dosage": radio_dosage,
+        "chemo_application": chemo_application_point,
+        "radio_application": radio_application_point,
+        "chemo_probabilities": chemo_probabilities,
+        "radio_probabilities": radio_probabilities,
+        "sequence_lengths": sequence_lengths,
+        "patient_types": patient_types,
+    }
+    # 这个地方的cancer volume就包括所有病人所有时间的肿瘤大小了了，当然有可能death或者康复了后面的时间就没有记录
+    # dosage应该是浓度大小，application是施加treatment与否
 
-        noise = 0.01 * np.random.randn(num_time_steps)  # 5% cell variability
-        recovery_rvs = np.random.rand(num_time_steps)
+    return outputs
 
-        # initial values
-        factual_cancer_volume = np.zeros(num_time_steps)
-        factual_chemo_dosage = np.zeros(num_time_steps)
-        factual_radio_dosage = np.zeros(num_time_steps)
-        factual_chemo_application_point = np.zeros(num_time_steps)
-        factual_radio_application_point = np.zeros(num_time_steps)
-        factual_chemo_probabilities = np.zeros(num_time_steps)
-        factual_radio_probabilities = np.zeros(num_time_steps)
 
-        chemo_application_rvs = np.random.rand(num_time_steps)
-        radio_application_rvs = np.random.rand(num_time_steps)
+@njit(fastmath=True, cache=True)
+def _factual_kernel(
+    initial_volumes,
+    alphas,
+    rhos,
+    betas,
+    beta_cs,
+    Ks,
+    chemo_sigmoid_intercepts,
+    radio_sigmoid_intercepts,
+    chemo_sigmoid_betas,
+    radio_sigmoid_betas,
+    noise_terms,
+    recovery_volumes,
+    chemo_application_rvs,
+    radio_application_rvs,
+    window_size,
+    treatment_options,
+    radio_amt,
+    chemo_amt,
+    decay,
+    death_threshold,
+):
+    """
+    Compiled factual pass shared by the test data generators.
+    Simulates the factual path of every patient with the clipped growth model, and
+    returns it together with the number of steps taken before death or recovery.
+    As in the original generators, patient i's treatment policy reads its lookback
+    window from test row i, so patients run in order and the first num_patients test
+    rows are rebuilt here.  An empty treatment_options array means one-step
+    counterfactual rows, otherwise the sequence projections of each option.
+    """
+    num_patients, num_time_steps = recovery_volumes.shape
+    num_options, projection_horizon = treatment_options.shape[:2]
+
+    # Test rows read back as policy windows, only the first num_patients can be
+    policy_rows = np.zeros((num_patients, num_time_steps + projection_horizon))
+    projection = np.empty(projection_horizon + 1)
+    test_idx = 0
+
+    factual_cancer_volume = np.zeros((num_patients, num_time_steps))
+    factual_chemo_dosage = np.zeros((num_patients, num_time_steps))
+    factual_chemo_application_point = np.zeros((num_patients, num_time_steps))
+    factual_radio_application_point = np.zeros((num_patients, num_time_steps))
+    num_steps = np.zeros(num_patients, dtype=np.int64)
 
-        factual_cancer_volume[0] = initial_volumes[i]
+    for i in range(num_patients):
+        noise = noise_terms[i]
 
+        # initial values
+        factual_cancer_volume[i, 0] = initial_volumes[i]
         alpha = alphas[i]
         beta = betas[i]
         beta_c = beta_cs[i]
         rho = rhos[i]
-        K = Ks[i]
+        log_K = math.log(Ks[i])  # growth only needs log(K / V)
+        chemo_sigmoid_beta = chemo_sigmoid_betas[i]
+        chemo_sigmoid_intercept = chemo_sigmoid_intercepts[i]
+        radio_sigmoid_beta = radio_sigmoid_betas[i]
+        radio_sigmoid_intercept = radio_sigmoid_intercepts[i]
 
+        steps = num_time_steps - 1
         for t in range(0, num_time_steps - 1):
 
-            # Factual treatments and outcomes
-            current_chemo_dose = 0.0
-            previous_chemo_dose = 0.0 if t == 0 else factual_chemo_dosage[t - 1]
+            previous_chemo_dose = 0.0 if t == 0 else factual_chemo_dosage[i, t - 1]
 
-            # Action probabilities + death or recovery simulations
-            cancer_volume_used = cancer_volume[i, max(t - window_size, 0) : t + 1]
-            cancer_diameter_used = np.array(
-                [calc_diameter(vol) for vol in cancer_volume_used],
-            ).mean()  # mean diameter over 15 days
-            cancer_metric_used = cancer_diameter_used
+            # mean diameter over the lookback window of test row i, which may still
+            # be filling up while patient i itself is simulated
+            window_start = max(t - window_size, 0)
+            diameter_sum = 0.0
+            for s in range(window_start, t + 1):
+                diameter_sum += calc_diameter(policy_rows[i, s])
+            cancer_metric_used = diameter_sum / (t + 1 - window_start)
 
             # probabilities
             radio_prob = 1.0 / (
                 1.0
-                + np.exp(
-                    -radio_sigmoid_betas[i]
-                    * (cancer_metric_used - radio_sigmoid_intercepts[i]),
+                + math.exp(
+                    -radio_sigmoid_beta
+                    * (cancer_metric_used - radio_sigmoid_intercept),
                 )
             )
             chemo_prob = 1.0 / (
                 1.0
-                + np.exp(
-                    -chemo_sigmoid_betas[i]
-                    * (cancer_metric_used - chemo_sigmoid_intercepts[i]),
+                + math.exp(
+                    -chemo_sigmoid_beta
+                    * (cancer_metric_used - chemo_sigmoid_intercept),
                 )
             )
 
-            factual_chemo_probabilities[t] = chemo_prob
-            factual_radio_probabilities[t] = radio_prob
+            # Action application, as a select rather than a branch on the random draw
+            apply_radio = 1.0 if radio_application_rvs[i, t] < radio_prob else 0.0
+            apply_chemo = 1.0 if chemo_application_rvs[i, t] < chemo_prob else 0.0
+            factual_radio_application_point[i, t] = apply_radio
+            factual_chemo_application_point[i, t] = apply_chemo
+            radio_dose = apply_radio * radio_amt
+            current_chemo_dose = apply_chemo * chemo_amt
 
-            # Action application
-            if radio_application_rvs[t] < radio_prob:
-                factual_radio_application_point[t] = 1
-                factual_radio_dosage[t] = radio_amt[0]
+            # Update chemo dosage
+            chemo_dose = _decay_chemo(previous_chemo_dose, current_chemo_dose, decay)
+            factual_chemo_dosage[i, t] = chemo_dose
+
+            next_volume = _growth_step(
+                factual_cancer_volume[i, t],
+                rho,
+                log_K,
+                beta_c,
+                chemo_dose,
+                alpha,
+                beta,
+                radio_dose,
+                noise[t + 1],
+            )  # add noise to fit residuals
+            next_volume = min(max(next_volume, 0.0), death_threshold)
+            factual_cancer_volume[i, t + 1] = next_volume
+
+            # Test rows of this step, in the order the generators write them
+            if test_idx < num_patients and num_options == 0:
+                # factual row, then the one-step counterfactual of every other option
+                policy_rows[test_idx, : t + 2] = factual_cancer_volume[i, : t + 2]
+                test_idx += 1
+                for option in range(4):
+                    chemo_point = float(option // 2)
+                    radio_point = float(option % 2)
+                    if chemo_point == apply_chemo and radio_point == apply_radio:
+                        continue
+                    if test_idx < num_patients:
+                        policy_rows[test_idx, : t + 1] = factual_cancer_volume[
+                            i, : t + 1
+                        ]
+                        policy_rows[test_idx, t + 1] = _growth_step(
+                            factual_cancer_volume[i, t],
+                            rho,
+                            log_K,
+                            beta_c,
+                            _decay_chemo(
+                                previous_chemo_dose,
+                                chemo_point * chemo_amt,
+                                decay,
+                            ),
+                            alpha,
+                            beta,
+                            radio_point * radio_amt,
+                            noise[t + 1],
+                        )
+                    test_idx += 1
+            elif test_idx < num_patients:
+                # one row per treatment option whose projection did not blow up
+                for k in range(num_options):
+                    projection[0] = next_volume
+                    projected = _project(
+                        projection,
+                        treatment_options[k],
+                        chemo_dose,
+                        alpha,
+                        beta,
+                        beta_c,
+                        rho,
+                        log_K,
+                        noise[t + 2 : t + 2 + projection_horizon],
+                        radio_amt,
+                        chemo_amt,
+                        decay,
+                    )
+                    if not projected:
+                        continue
+                    if test_idx < num_patients:
+                        policy_rows[test_idx, : t + 2] = factual_cancer_volume[
+                            i, : t + 2
+                        ]
+                        policy_rows[
+                            test_idx, t + 2 : t + 2 + projection_horizon
+                        ] = projection[1:]
+                    test_idx += 1
+
+            if (next_volume >= death_threshold) or (
+                next_volume <= recovery_volumes[i, t]
+            ):
+                steps = t + 1
+                break
 
-            if chemo_application_rvs[t] < chemo_prob:
-                factual_chemo_application_point[t] = 1
-                current_chemo_dose = chemo_amt[0]
+        num_steps[i] = steps
 
-            # Update chemo dosage
-            factual_chemo_dosage[t] = (
-                previous_chemo_dose * np.exp(-np.log(2) / drug_half_life)
-                + current_chemo_dose
-            )
+    return (
+        factual_cancer_volume,
+        factual_chemo_dosage,
+        factual_chemo_application_point,
+        factual_radio_application_point,
+        num_steps,
+    )
 
-            # Factual treatments and outcomes
-            factual_cancer_volume[t + 1] = factual_cancer_volume[t] * (
-                1
-                + rho * np.log(K / factual_cancer_volume[t])
-                - beta_c * factual_chemo_dosage[t]
-                - (
-                    alpha * factual_radio_dosage[t]
-                    + beta * factual_radio_dosage[t] ** 2
-                )
-                + noise[t + 1]
-            )  # add noise to fit residuals
 
-            factual_cancer_volume[t + 1] = np.clip(
-                factual_cancer_volume[t + 1],
-                0,
-                tumour_death_threshold,
-            )
+@njit(parallel=True, fastmath=True, cache=True)
+def _counterfactual_kernel(
+    factual_cancer_volume,
+    factual_chemo_dosage,
+    factual_chemo_application_point,
+    factual_radio_application_point,
+    num_steps,
+    alphas,
+    rhos,
+    betas,
+    beta_cs,
+    Ks,
+    patient_types,
+    noise_terms,
+    radio_amt,
+    chemo_amt,
+    decay,
+):
+    """
+    Compiled inner loop of simulate_counterfactual_test_data.
+    Writes the factual row and the 3 one-step counterfactual rows of every factual step.
+    Each patient owns a fixed block of output rows, so patients run in parallel.
+    """
+    num_patients, num_time_steps = factual_cancer_volume.shape
+    num_treatments = (
+        4  # No treatment/Radiotherapy/Chemotherapy/Chemotherapy + Radiotherapy
+    )
 
-            # Popoulate arrays
-            cancer_volume[test_idx] = factual_cancer_volume
-            chemo_application_point[test_idx] = factual_chemo_application_point
-            radio_application_point[test_idx] = factual_radio_application_point
-            patient_types_all_trajectories[test_idx] = patient_types[i]
-            sequence_lengths[test_idx] = int(t) + 1
-            test_idx = test_idx + 1
-
-            # Counterfactual treatments and outcomes
-            treatment_options = [
-                (0, 0),
-                (0, 1),
-                (1, 0),
-                (1, 1),
-            ]  # First = chemo; second = radio
-
-            for treatment_option in treatment_options:
-                if (
-                    factual_chemo_application_point[t] == treatment_option[0]
-                    and factual_radio_application_point[t] == treatment_option[1]
-                ):
-                    # This represents the factual treatment which was already considered
-                    continue
-                current_chemo_dose = 0.0
-                counterfactual_radio_dosage = 0.0
-                counterfactual_chemo_application_point = 0
-                counterfactual_radio_application_point = 0
-
-                if treatment_option[0] == 1:
-                    counterfactual_chemo_application_point = 1
-                    current_chemo_dose = chemo_amt[0]
-
-                if treatment_option[1] == 1:
-                    counterfactual_radio_application_point = 1
-                    counterfactual_radio_dosage = radio_amt[0]
-
-                counterfactual_chemo_dosage = (
-                    previous_chemo_dose * np.exp(-np.log(2) / drug_half_life)
-                    + current_chemo_dose
-                )
+    # Every step yields the factual row followed by one row per other treatment option
+    row_offsets = np.zeros(num_patients + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum(num_steps * num_treatments)
+    num_test_points = row_offsets[-1]
 
-                counterfactual_cancer_volume = factual_cancer_volume[t] * (
-                    1
-                    + rho * np.log(K / factual_cancer_volume[t])
-                    - beta_c * counterfactual_chemo_dosage
-                    - (
-                        alpha * counterfactual_radio_dosage
-                        + beta * counterfactual_radio_dosage**2
-                    )
-                    + noise[t + 1]
-                )
+    # Test rows are stored in float32 to halve the size of the largest buffers
+    cancer_volume = np.zeros((num_test_points, num_time_steps), dtype=np.float32)
+    chemo_application_point = np.zeros(
+        (num_test_points, num_time_steps),
+        dtype=np.float32,
+    )
+    radio_application_point = np.zeros(
+        (num_test_points, num_time_steps),
+        dtype=np.float32,
+    )
+    sequence_lengths = np.zeros(num_test_points)
+    patient_types_all_trajectories = np.zeros(num_test_points)
 
-                cancer_volume[test_idx][: t + 2] = np.append(
-                    factual_cancer_volume[: t + 1],
-                    [counterfactual_cancer_volume],
-                )
-                chemo_application_point[test_idx][: t + 1] = np.append(
-                    factual_chemo_application_point[:t],
-                    [counterfactual_chemo_application_point],
+    for i in prange(num_patients):
+        noise = noise_terms[i]
+        alpha = alphas[i]
+        beta = betas[i]
+        beta_c = beta_cs[i]
+        rho = rhos[i]
+        log_K = math.log(Ks[i])  # growth only needs log(K / V)
+
+        test_idx = row_offsets[i]
+        for t in range(num_steps[i]):
+            previous_chemo_dose = 0.0 if t == 0 else factual_chemo_dosage[i, t - 1]
+            factual_chemo = factual_chemo_application_point[i, t]
+            factual_radio = factual_radio_application_point[i, t]
+
+            # Factual row: the path simulated so far, zero afterwards
+            cancer_volume[test_idx, : t + 2] = factual_cancer_volume[i, : t + 2]
+            chemo_application_point[
+                test_idx, : t + 1
+            ] = factual_chemo_application_point[i, : t + 1]
+            radio_application_point[
+                test_idx, : t + 1
+            ] = factual_radio_application_point[i, : t + 1]
+            patient_types_all_trajectories[test_idx] = patient_types[i]
+            sequence_lengths[test_idx] = t + 1
+            test_idx += 1
+
+            # Counterfactual rows, options indexed by 2 * chemo + radio
+            for option in range(num_treatments):
+                chemo_point = float(option // 2)
+                radio_point = float(option % 2)
+                if chemo_point == factual_chemo and radio_point == factual_radio:
+                    continue  # already stored above
+
+                counterfactual_chemo_dose = _decay_chemo(
+                    previous_chemo_dose,
+                    chemo_point * chemo_amt,
+                    decay,
                 )
-                radio_application_point[test_idx][: t + 1] = np.append(
-                    factual_radio_application_point[:t],
-                    [counterfactual_radio_application_point],
+                cancer_volume[test_idx, : t + 1] = factual_cancer_volume[i, : t + 1]
+                cancer_volume[test_idx, t + 1] = _growth_step(
+                    factual_cancer_volume[i, t],
+                    rho,
+                    log_K,
+                    beta_c,
+                    counterfactual_chemo_dose,
+                    alpha,
+                    beta,
+                    radio_point * radio_amt,
+                    noise[t + 1],
                 )
+                chemo_application_point[test_idx, :t] = factual_chemo_application_point[
+                    i, :t
+                ]
+                chemo_application_point[test_idx, t] = chemo_point
+                radio_application_point[test_idx, :t] = factual_radio_application_point[
+                    i, :t
+                ]
+                radio_application_point[test_idx, t] = radio_point
                 patient_types_all_trajectories[test_idx] = patient_types[i]
-                sequence_lengths[test_idx] = int(t) + 1
-                test_idx = test_idx + 1
-
-            if (factual_cancer_volume[t + 1] >= tumour_death_threshold) or recovery_rvs[
-                t
-            ] <= np.exp(-factual_cancer_volume[t + 1] * tumour_cell_density):
-                break
-
-    outputs = {
-        "cancer_volume": cancer_volume[:test_idx],
-        "chemo_application": chemo_application_point[:test_idx],
-        "radio_application": radio_application_point[:test_idx],
-        "sequence_lengths": sequence_lengths[:test_idx],
-        "patient_types": patient_types_all_trajectories[:test_idx],
-    }
-
-    print("Call to simulate counterfactuals data")
-
-    return outputs
+                sequence_lengths[test_idx] = t + 1
+                test_idx += 1
+
+    return (
+        cancer_volume,
+        chemo_application_point,
+        radio_application_point,
+        sequence_lengths,
+        patient_types_all_trajectories,
+    )
 
 
-def simulate_sequence_test(
+def simulate_counterfactual_test_data(
     simulation_params,
     num_time_steps,
-    projection_horizon,
-    treatment_options,
+    assigned_actions=None,
 ):
     """
     Core routine to generate simulation test paths to asses all of the counterfactuals.
-
+    就是对于原来的factual产生synthetic dataset的过程，迭代所有的treatment，产生对应的tumor大小
     :param simulation_params:
     :param num_time_steps:
     :param assigned_actions:
     :return:
     """
-
-    np.random.seed(100)
+    rng = np.random.default_rng(100)
 
     total_num_radio_treatments = 1
     total_num_chemo_treatments = 1
@@ -724,6 +923,7 @@ def simulate_sequence_test(
     chemo_days = np.array(chemo_days)[chemo_idx]
 
     drug_half_life = 1  # one day half life for drugs
+    decay = math.exp(-math.log(2) / drug_half_life)  # daily chemo decay factor
 
     # Unpack simulation parameters
     initial_stages = simulation_params["initial_stages"]
@@ -746,214 +946,407 @@ def simulate_sequence_test(
 
     num_patients = initial_stages.shape[0]
 
-    num_test_points = 2 * num_patients * num_time_steps * projection_horizon
+    noise_terms = 0.01 * rng.standard_normal(
+        (num_patients, num_time_steps),
+    )  # 5% cell variability
+    recovery_rvs = rng.random((num_patients, num_time_steps))
+    # Recovery when rv < exp(-V * density), i.e. once V drops below -log(rv) / density
+    recovery_volumes = -np.log(recovery_rvs) / tumour_cell_density
 
-    # Commence Simulation
-    cancer_volume = np.zeros((num_test_points, num_time_steps + projection_horizon))
-    chemo_application_point = np.zeros(
-        (num_test_points, num_time_steps + projection_horizon),
+    chemo_application_rvs = rng.random((num_patients, num_time_steps))
+    radio_application_rvs = rng.random((num_patients, num_time_steps))
+
+    # Run actual simulation
+    logging.info("Simulating {} patients".format(num_patients))
+    (
+        factual_cancer_volume,
+        factual_chemo_dosage,
+        factual_chemo_application_point,
+        factual_radio_application_point,
+        num_steps,
+    ) = _factual_kernel(
+        initial_volumes,
+        alphas,
+        rhos,
+        betas,
+        beta_cs,
+        Ks,
+        chemo_sigmoid_intercepts,
+        radio_sigmoid_intercepts,
+        chemo_sigmoid_betas,
+        radio_sigmoid_betas,
+        noise_terms,
+        recovery_volumes,
+        chemo_application_rvs,
+        radio_application_rvs,
+        window_size,
+        np.zeros((0, 0, 2), dtype=np.int8),  # one-step counterfactual rows
+        radio_amt[0],
+        chemo_amt[0],
+        decay,
+        tumour_death_threshold,
     )
-    radio_application_point = np.zeros(
-        (num_test_points, num_time_steps + projection_horizon),
+    (
+        cancer_volume,
+        chemo_application_point,
+        radio_application_point,
+        sequence_lengths,
+        patient_types_all_trajectories,
+    ) = _counterfactual_kernel(
+        factual_cancer_volume,
+        factual_chemo_dosage,
+        factual_chemo_application_point,
+        factual_radio_application_point,
+        num_steps,
+        alphas,
+        rhos,
+        betas,
+        beta_cs,
+        Ks,
+        np.asarray(patient_types, dtype=np.float64),
+        noise_terms,
+        radio_amt[0],
+        chemo_amt[0],
+        decay,
     )
-    sequence_lengths = np.zeros(num_test_points)
-    patient_types_all_trajectories = np.zeros(num_test_points)
-    patient_ids_all_trajectories = np.zeros(num_test_points)
-    patient_current_t = np.zeros(num_test_points)
 
-    test_idx = 0
+    outputs = {
+        "cancer_volume": cancer_volume,
+        "chemo_application": chemo_application_point,
+        "radio_application": radio_application_point,
+        "sequence_lengths": sequence_lengths,
+        "patient_types": patient_types_all_trajectories,
+    }
 
-    # Run actual simulation
-    for i in range(num_patients):
+    print("Call to simulate counterfactuals data")
 
-        if i % 200 == 0:
-            logging.info("Simulating patient {} of {}".format(i, num_patients))
+    return outputs
 
-        noise = 0.01 * np.random.randn(num_time_steps + 20)  # 5% cell variability
-        recovery_rvs = np.random.rand(num_time_steps)
 
-        # initial values
-        factual_cancer_volume = np.zeros(num_time_steps)
-        factual_chemo_dosage = np.zeros(num_time_steps)
-        factual_radio_dosage = np.zeros(num_time_steps)
-        factual_chemo_application_point = np.zeros(num_time_steps)
-        factual_radio_application_point = np.zeros(num_time_steps)
-        factual_chemo_probabilities = np.zeros(num_time_steps)
-        factual_radio_probabilities = np.zeros(num_time_steps)
+# fastmath without nnan/ninf - blown up projections are detected by their NaNs
+_projection_fastmath = {"nsz", "arcp", "contract", "afn", "reassoc"}
+
+
+@njit(fastmath=_projection_fastmath, cache=True, error_model="numpy")
+def _project(
+    counterfactual_cancer_volume,
+    treatment_option,
+    previous_chemo_dose,
+    alpha,
+    beta,
+    beta_c,
+    rho,
+    log_K,
+    noise,
+    radio_amt,
+    chemo_amt,
+    decay,
+):
+    """
+    Compiled projection of simulate_sequence_test - applies treatment_option to the
+    volume in counterfactual_cancer_volume[0], filling the projected tail in place.
+    Returns False as soon as the projected volume turns NaN, the rest is left unfilled.
+    """
+    chemo_dose = previous_chemo_dose
+    projection_horizon = treatment_option.shape[0]
+    for projection_time in range(0, projection_horizon):
+
+        # Every step is computed from the 0/1 flags, no branches on the option
+        chemo_dose = _decay_chemo(
+            chemo_dose,
+            treatment_option[projection_time, 0] * chemo_amt,
+            decay,
+        )
+        radio_dose = treatment_option[projection_time, 1] * radio_amt
+
+        # projected volumes are not clipped and can reach zero, hence the guard
+        counterfactual_cancer_volume[projection_time + 1] = _growth_step(
+            counterfactual_cancer_volume[projection_time],
+            rho,
+            log_K,
+            beta_c,
+            chemo_dose,
+            alpha,
+            beta,
+            radio_dose,
+            noise[projection_time],
+            1e-07,
+        )
+        if np.isnan(counterfactual_cancer_volume[projection_time + 1]):
+            return False  # blown up
 
-        chemo_application_rvs = np.random.rand(num_time_steps)
-        radio_application_rvs = np.random.rand(num_time_steps)
+    return True
 
-        factual_cancer_volume[0] = initial_volumes[i]
 
+@njit(
+    parallel=True,
+    fastmath=_projection_fastmath,
+    cache=True,
+    error_model="numpy",
+)
+def _sequence_kernel(
+    factual_cancer_volume,
+    factual_chemo_dosage,
+    factual_chemo_application_point,
+    factual_radio_application_point,
+    num_steps,
+    alphas,
+    rhos,
+    betas,
+    beta_cs,
+    Ks,
+    patient_types,
+    noise_terms,
+    treatment_options,
+    radio_amt,
+    chemo_amt,
+    decay,
+):
+    """
+    Compiled inner loop of simulate_sequence_test.
+    Every factual step yields one row per treatment option, projected projection_horizon
+    steps ahead.  Each patient owns a fixed block of output rows, so patients run in
+    parallel; rows whose projection blew up are flagged invalid for the caller to drop.
+    """
+    num_patients, num_time_steps = factual_cancer_volume.shape
+    num_options, projection_horizon = treatment_options.shape[:2]
+    row_length = num_time_steps + projection_horizon
+
+    row_offsets = np.zeros(num_patients + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum(num_steps * num_options)
+    num_test_points = row_offsets[-1]
+
+    # Test rows are stored in float32, the projections run in the float64 scratch below
+    cancer_volume = np.zeros((num_test_points, row_length), dtype=np.float32)
+    chemo_application_point = np.zeros((num_test_points, row_length), dtype=np.float32)
+    radio_application_point = np.zeros((num_test_points, row_length), dtype=np.float32)
+    sequence_lengths = np.zeros(num_test_points)
+    patient_types_all_trajectories = np.zeros(num_test_points)
+    patient_ids_all_trajectories = np.zeros(num_test_points)
+    patient_current_t = np.zeros(num_test_points)
+    valid = np.zeros(num_test_points, dtype=np.bool_)
+
+    # Per-patient scratch for the projected tail only, the factual prefix is copied
+    # straight from the factual paths into the output rows
+    counterfactual_cancer_volumes = np.empty((num_patients, projection_horizon + 1))
+
+    for i in prange(num_patients):
+        noise = noise_terms[i]
         alpha = alphas[i]
         beta = betas[i]
         beta_c = beta_cs[i]
         rho = rhos[i]
-        K = Ks[i]
-
-        for t in range(0, num_time_steps - 1):
+        log_K = math.log(Ks[i])  # growth only needs log(K / V)
+        counterfactual_cancer_volume = counterfactual_cancer_volumes[i]
+
+        test_idx = row_offsets[i]
+        for t in range(num_steps[i]):
+            for k in range(num_options):
+
+                # Project from the factual volume after step t
+                counterfactual_cancer_volume[0] = factual_cancer_volume[i, t + 1]
+                projected = _project(
+                    counterfactual_cancer_volume,
+                    treatment_options[k],
+                    factual_chemo_dosage[i, t],
+                    alpha,
+                    beta,
+                    beta_c,
+                    rho,
+                    log_K,
+                    noise[t + 2 : t + 2 + projection_horizon],
+                    radio_amt,
+                    chemo_amt,
+                    decay,
+                )
 
-            # Factual treatments and outcomes
-            current_chemo_dose = 0.0
-            previous_chemo_dose = 0.0 if t == 0 else factual_chemo_dosage[t - 1]
+                if not projected:
+                    test_idx += 1
+                    continue
 
-            # Action probabilities + death or recovery simulations
-            cancer_volume_used = cancer_volume[i, max(t - window_size, 0) : t + 1]
-            cancer_diameter_used = np.array(
-                [calc_diameter(vol) for vol in cancer_volume_used],
-            ).mean()  # mean diameter over 15 days
-            cancer_metric_used = cancer_diameter_used
+                cancer_volume[test_idx, : t + 2] = factual_cancer_volume[i, : t + 2]
+                cancer_volume[
+                    test_idx, t + 2 : t + 2 + projection_horizon
+                ] = counterfactual_cancer_volume[1:]
+                chemo_application_point[
+                    test_idx, : t + 1
+                ] = factual_chemo_application_point[i, : t + 1]
+                chemo_application_point[
+                    test_idx, t + 1 : t + 1 + projection_horizon
+                ] = treatment_options[k, :, 0]
+                radio_application_point[
+                    test_idx, : t + 1
+                ] = factual_radio_application_point[i, : t + 1]
+                radio_application_point[
+                    test_idx, t + 1 : t + 1 + projection_horizon
+                ] = treatment_options[k, :, 1]
+                patient_types_all_trajectories[test_idx] = patient_types[i]
+                patient_ids_all_trajectories[test_idx] = i
+                patient_current_t[test_idx] = t
 
-            # probabilities
-            radio_prob = 1.0 / (
-                1.0
-                + np.exp(
-                    -radio_sigmoid_betas[i]
-                    * (cancer_metric_used - radio_sigmoid_intercepts[i]),
-                )
-            )
-            chemo_prob = 1.0 / (
-                1.0
-                + np.exp(
-                    -chemo_sigmoid_betas[i]
-                    * (cancer_metric_used - chemo_sigmoid_intercepts[i]),
-                )
-            )
+                sequence_lengths[test_idx] = t + 2
+                valid[test_idx] = True
+                test_idx += 1
+
+    return (
+        cancer_volume,
+        chemo_application_point,
+        radio_application_point,
+        sequence_lengths,
+        patient_types_all_trajectories,
+        patient_ids_all_trajectories,
+        patient_current_t,
+        valid,
+    )
 
-            factual_chemo_probabilities[t] = chemo_prob
-            factual_radio_probabilities[t] = radio_prob
 
-            # Action application
-            if radio_application_rvs[t] < radio_prob:
-                factual_radio_application_point[t] = 1
-                factual_radio_dosage[t] = radio_amt[0]
+def simulate_sequence_test(
+    simulation_params,
+    num_time_steps,
+    projection_horizon,
+    treatment_options,
+):
+    """
+    Core routine to generate simulation test paths to asses all of the counterfactuals.
 
-            if chemo_application_rvs[t] < chemo_prob:
-                factual_chemo_application_point[t] = 1
-                current_chemo_dose = chemo_amt[0]
+    :param simulation_params:
+    :param num_time_steps:
+    :param assigned_actions:
+    :return:
+    """
 
-            # Update chemo dosage
-            factual_chemo_dosage[t] = (
-                previous_chemo_dose * np.exp(-np.log(2) / drug_half_life)
-                + current_chemo_dose
-            )
+    rng = np.random.default_rng(100)
 
-            # Factual treatments and outcomes
-            factual_cancer_volume[t + 1] = factual_cancer_volume[t] * (
-                1
-                + rho * np.log(K / factual_cancer_volume[t])
-                - beta_c * factual_chemo_dosage[t]
-                - (
-                    alpha * factual_radio_dosage[t]
-                    + beta * factual_radio_dosage[t] ** 2
-                )
-                + noise[t + 1]
-            )  # add noise to fit residuals
+    total_num_radio_treatments = 1
+    total_num_chemo_treatments = 1
 
-            factual_cancer_volume[t + 1] = np.clip(
-                factual_cancer_volume[t + 1],
-                0,
-                tumour_death_threshold,
-            )
+    radio_amt = np.array([2.0 for i in range(total_num_radio_treatments)])  # Gy
+    radio_days = np.array([i + 1 for i in range(total_num_radio_treatments)])
+    chemo_amt = [5.0 for i in range(total_num_chemo_treatments)]
+    chemo_days = [(i + 1) * 7 for i in range(total_num_chemo_treatments)]
 
-            for treatment_option in treatment_options:
+    # sort this
+    chemo_idx = np.argsort(chemo_days)
+    chemo_amt = np.array(chemo_amt)[chemo_idx]
+    chemo_days = np.array(chemo_days)[chemo_idx]
 
-                counterfactual_cancer_volume = np.zeros(
-                    shape=(t + 1 + projection_horizon + 1),
-                )
-                counterfactual_chemo_application_point = np.zeros(
-                    shape=(t + 1 + projection_horizon),
-                )
-                counterfactual_radio_application_point = np.zeros(
-                    shape=(t + 1 + projection_horizon),
-                )
-                counterfactual_chemo_dosage = np.zeros(
-                    shape=(t + 1 + projection_horizon),
-                )
-                counterfactual_radio_dosage = np.zeros(
-                    shape=(t + 1 + projection_horizon),
-                )
+    drug_half_life = 1  # one day half life for drugs
+    decay = math.exp(-math.log(2) / drug_half_life)  # daily chemo decay factor
 
-                counterfactual_cancer_volume[: t + 2] = factual_cancer_volume[: t + 2]
-                counterfactual_chemo_application_point[
-                    : t + 1
-                ] = factual_chemo_application_point[: t + 1]
-                counterfactual_radio_application_point[
-                    : t + 1
-                ] = factual_radio_application_point[: t + 1]
-                counterfactual_chemo_dosage[: t + 1] = factual_chemo_dosage[: t + 1]
-                counterfactual_radio_dosage[: t + 1] = factual_radio_dosage[: t + 1]
-
-                for projection_time in range(0, projection_horizon):
-
-                    current_t = t + 1 + projection_time
-                    previous_chemo_dose = counterfactual_chemo_dosage[current_t - 1]
-
-                    current_chemo_dose = 0.0
-                    counterfactual_radio_dosage[current_t] = 0.0
-                    if treatment_option[projection_time][0] == 1:
-                        counterfactual_chemo_application_point[current_t] = 1
-                        current_chemo_dose = chemo_amt[0]
-
-                    if treatment_option[projection_time][1] == 1:
-                        counterfactual_radio_application_point[current_t] = 1
-                        counterfactual_radio_dosage[current_t] = radio_amt[0]
-
-                    counterfactual_chemo_dosage[current_t] = (
-                        previous_chemo_dose * np.exp(-np.log(2) / drug_half_life)
-                        + current_chemo_dose
-                    )
+    # Unpack simulation parameters
+    initial_stages = simulation_params["initial_stages"]
+    initial_volumes = simulation_params["initial_volumes"]
+    alphas = simulation_params["alpha"]
+    rhos = simulation_params["rho"]
+    betas = simulation_params["beta"]
+    beta_cs = simulation_params["beta_c"]
+    Ks = simulation_params["K"]
+    patient_types = simulation_params["patient_types"]
+    window_size = simulation_params[
+        "window_size"
+    ]  # controls the lookback of the treatment assignment policy
 
-                    counterfactual_cancer_volume[
-                        current_t + 1
-                    ] = counterfactual_cancer_volume[current_t] * (
-                        1
-                        + rho
-                        * np.log(
-                            K / (counterfactual_cancer_volume[current_t] + 1e-07)
-                            + 1e-07,
-                        )
-                        - beta_c * counterfactual_chemo_dosage[current_t]
-                        - (
-                            alpha * counterfactual_radio_dosage[current_t]
-                            + beta * counterfactual_radio_dosage[current_t] ** 2
-                        )
-                        + noise[current_t + 1]
-                    )
+    # Coefficients for treatment assignment probabilities
+    chemo_sigmoid_intercepts = simulation_params["chemo_sigmoid_intercepts"]
+    radio_sigmoid_intercepts = simulation_params["radio_sigmoid_intercepts"]
+    chemo_sigmoid_betas = simulation_params["chemo_sigmoid_betas"]
+    radio_sigmoid_betas = simulation_params["radio_sigmoid_betas"]
 
-                if np.isnan(counterfactual_cancer_volume).any():
-                    continue
+    num_patients = initial_stages.shape[0]
 
-                cancer_volume[test_idx][
-                    : t + 1 + projection_horizon + 1
-                ] = counterfactual_cancer_volume
-                chemo_application_point[test_idx][
-                    : t + 1 + projection_horizon
-                ] = counterfactual_chemo_application_point
-                radio_application_point[test_idx][
-                    : t + 1 + projection_horizon
-                ] = counterfactual_radio_application_point
-                patient_types_all_trajectories[test_idx] = patient_types[i]
-                patient_ids_all_trajectories[test_idx] = i
-                patient_current_t[test_idx] = t
+    # Packed 0/1 flags of shape (options, horizon, [chemo, radio]), fixed dtype so the
+    # compiled projection is reused from the cache
+    treatment_options = np.asarray(treatment_options, dtype=np.int8)
+    if treatment_options.shape[1] < projection_horizon:
+        raise ValueError(
+            "treatment_options cover fewer than projection_horizon={} steps.".format(
+                projection_horizon,
+            ),
+        )
+    treatment_options = np.ascontiguousarray(treatment_options[:, :projection_horizon])
 
-                sequence_lengths[test_idx] = int(t) + 2
-                test_idx = test_idx + 1
+    # The projections read noise up to num_time_steps + projection_horizon - 1, which
+    # the compiled kernels do not bounds check
+    noise_terms = 0.01 * rng.standard_normal(
+        (num_patients, num_time_steps + max(20, projection_horizon)),
+    )  # 5% cell variability
+    recovery_rvs = rng.random((num_patients, num_time_steps))
+    # Recovery when rv < exp(-V * density), i.e. once V drops below -log(rv) / density
+    recovery_volumes = -np.log(recovery_rvs) / tumour_cell_density
+
+    chemo_application_rvs = rng.random((num_patients, num_time_steps))
+    radio_application_rvs = rng.random((num_patients, num_time_steps))
+
+    # Factual paths, the projections below branch off them at every step
+    logging.info("Simulating {} patients".format(num_patients))
+    (
+        factual_cancer_volumes,
+        factual_chemo_dosages,
+        factual_chemo_application_points,
+        factual_radio_application_points,
+        num_steps,
+    ) = _factual_kernel(
+        initial_volumes,
+        alphas,
+        rhos,
+        betas,
+        beta_cs,
+        Ks,
+        chemo_sigmoid_intercepts,
+        radio_sigmoid_intercepts,
+        chemo_sigmoid_betas,
+        radio_sigmoid_betas,
+        noise_terms,
+        recovery_volumes,
+        chemo_application_rvs,
+        radio_application_rvs,
+        window_size,
+        treatment_options,
+        radio_amt[0],
+        chemo_amt[0],
+        decay,
+        tumour_death_threshold,
+    )
 
-            if (factual_cancer_volume[t + 1] >= tumour_death_threshold) or recovery_rvs[
-                t
-            ] <= np.exp(-factual_cancer_volume[t + 1] * tumour_cell_density):
-                break
+    logging.info("Projecting {} patients".format(num_patients))
+    (
+        cancer_volume,
+        chemo_application_point,
+        radio_application_point,
+        sequence_lengths,
+        patient_types_all_trajectories,
+        patient_ids_all_trajectories,
+        patient_current_t,
+        valid,
+    ) = _sequence_kernel(
+        factual_cancer_volumes,
+        factual_chemo_dosages,
+        factual_chemo_application_points,
+        factual_radio_application_points,
+        num_steps,
+        alphas,
+        rhos,
+        betas,
+        beta_cs,
+        Ks,
+        np.asarray(patient_types, dtype=np.float64),
+        noise_terms,
+        treatment_options,
+        radio_amt[0],
+        chemo_amt[0],
+        decay,
+    )
 
+    # Drop the projections that blew up
+    valid_rows = np.flatnonzero(valid)
     outputs = {
-        "cancer_volume": cancer_volume[:test_idx],
-        "chemo_application": chemo_application_point[:test_idx],
-        "radio_application": radio_application_point[:test_idx],
-        "sequence_lengths": sequence_lengths[:test_idx],
-        "patient_types": patient_types_all_trajectories[:test_idx],
-        "patient_ids_all_trajectories": patient_ids_all_trajectories[:test_idx],
-        "patient_current_t": patient_current_t[:test_idx],
+        "cancer_volume": cancer_volume[valid_rows],
+        "chemo_application": chemo_application_point[valid_rows],
+        "radio_application": radio_application_point[valid_rows],
+        "sequence_lengths": sequence_lengths[valid_rows],
+        "patient_types": patient_types_all_trajectories[valid_rows],
+        "patient_ids_all_trajectories": patient_ids_all_trajectories[valid_rows],
+        "patient_current_t": patient_current_t[valid_rows],
     }
 
     print("Call to simulate counterfactuals data")
@@ -969,13 +1362,13 @@ def get_scaling_params(sim):
     stds = {}
     seq_lengths = sim["sequence_lengths"]
     for k in real_idx:
-        active_values = []
-        for i in range(seq_lengths.shape[0]):
-            end = int(seq_lengths[i])
-            active_values += list(sim[k][i, :end])
+        # Only the steps before each patient's end of sequence are active
+        num_time_steps = sim[k].shape[1]
+        active = np.arange(num_time_steps)[np.newaxis, :] < seq_lengths[:, np.newaxis]
+        active_values = sim[k][active]
 
-        means[k] = np.mean(active_values)
-        stds[k] = np.std(active_values)
+        means[k] = active_values.mean(dtype=np.float64)
+        stds[k] = active_values.std(dtype=np.float64)
 
     # Add means for static variables`
     means["patient_types"] = np.mean(sim["patient_types"])
@@ -989,6 +1382,8 @@ def get_scaling_params(sim):
 
 
 def plot_treatments(patient):
+    import matplotlib.pyplot as plt  # only needed for plotting, heavy to import
+
     df = pd.DataFrame(
         {
             "N(t)": outputs["cancer_volume"][patient],
@@ -1027,43 +1422,42 @@ def get_cancer_sim_data(
 
     def _generate():
         num_time_steps = 60  # about half a year
-        np.random.seed(seed)
+        rng = np.random.default_rng(seed)
         num_patients = 10000
 
-        params = get_confounding_params(
-            num_patients,
+        # Draw the parameters of all four cohorts at once and split them, the patients
+        # are already shuffled by get_standard_params
+        cohort_sizes = [num_patients] + [int(num_patients / 10)] * 3
+        all_params = get_confounding_params(
+            sum(cohort_sizes),
             chemo_coeff=chemo_coeff,
             radio_coeff=radio_coeff,
+            rng=rng,
         )  # 这一步只是得到parameters，当然parameters本身是可以对于每个病人的
+        cohort_bounds = np.cumsum([0] + cohort_sizes)
+        cohort_params = [
+            {k: v[start:stop] for k, v in all_params.items()}
+            for start, stop in zip(cohort_bounds[:-1], cohort_bounds[1:])
+        ]
+
+        params = cohort_params[0]
         params["window_size"] = window_size
-        training_data = simulate(params, num_time_steps)
+        training_data = simulate(params, num_time_steps, rng=rng)
 
-        params = get_confounding_params(
-            int(num_patients / 10),
-            chemo_coeff=chemo_coeff,
-            radio_coeff=radio_coeff,
-        )
+        params = cohort_params[1]
         params["window_size"] = window_size
-        validation_data = simulate(params, num_time_steps)
+        validation_data = simulate(params, num_time_steps, rng=rng)
 
-        params = get_confounding_params(
-            int(num_patients / 10),
-            chemo_coeff=chemo_coeff,
-            radio_coeff=radio_coeff,
-        )
+        params = cohort_params[2]
         params["window_size"] = window_size
-        test_data_factuals = simulate(params, num_time_steps)
+        test_data_factuals = simulate(params, num_time_steps, rng=rng)
         # 到这里为止，就是正常的每个病人有各自不同的treatment，当然也有各自不同的tumor v
         test_data_counterfactuals = simulate_counterfactual_test_data(
             params,
             num_time_steps,
         )
 
-        params = get_confounding_params(
-            int(num_patients / 10),
-            chemo_coeff=chemo_coeff,
-            radio_coeff=radio_coeff,
-        )
+        params = cohort_params[3]
         params["window_size"] = window_size
         treatment_options = np.array(
             [
@@ -1078,6 +1472,7 @@ def get_cancer_sim_data(
                 [(0, 0), (0, 0), (0, 0), (0, 1), (0, 0)],
                 [(0, 0), (0, 0), (0, 0), (0, 0), (0, 1)],
             ],
+            dtype=np.int8,
         )
         test_data_seq = simulate_sequence_test(
             params,
@@ -1107,7 +1502,8 @@ def get_cancer_sim_data(
 
         if b_save:
             logging.info("Saving pickle map to {}".format(pickle_file))
-            pickle.dump(pickle_map, open(pickle_file, "wb"))
+            with open(pickle_file, "wb") as f:
+                pickle.dump(pickle_map, f)
         return pickle_map
 
     # Controls whether to regenerate the data, or load from a persisted file
@@ -1118,7 +1514,8 @@ def get_cancer_sim_data(
         logging.info("Loading pickle map from {}".format(pickle_file))
 
         try:
-            pickle_map = pickle.load(open(pickle_file, "rb"))
+            with open(pickle_file, "rb") as f:
+                pickle_map = pickle.load(f)
 
         except IOError:
             logging.info(
@@ -1136,7 +1533,7 @@ def get_cancer_sim_data(
 if __name__ == "__main__":
     logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
 
-    np.random.seed(100)
+    rng = np.random.default_rng(100)
 
     num_time_steps = 60  # 6 month followup
     num_patients = 200
@@ -1145,6 +1542,7 @@ if __name__ == "__main__":
         num_patients,
         chemo_coeff=5.0,
         radio_coeff=5.0,
+        rng=rng,
     )
     simulation_params["window_size"] = 15
 
@@ -1154,9 +1552,10 @@ if __name__ == "__main__":
             [(1, 0), (0, 0), (0, 1), (0, 0), (0, 0)],
             [(0, 0), (1, 0), (0, 1), (0, 0), (0, 0)],
         ],
+        dtype=np.int8,
     )
 
-    outputs = simulate(simulation_params, num_time_steps)
+    outputs = simulate(simulation_params, num_time_steps, rng=rng)
 
     print(outputs["cancer_volume"][:10])
     print(outputs["chemo_probabilities"][:10])